@@ -5,9 +5,11 @@ This is a query rewrite of https://github.com/serverstf/python-valve
 """
 
 from io import BytesIO
+import re
 import struct
 import socket
 import time
+from types import MappingProxyType
 
 """Constant values from https://developer.valvesoftware.com/wiki/Server_queries"""
 
@@ -17,14 +19,50 @@ SPLIT = -2
 
 A2S_INFO_HEADER = ord('T')
 A2S_INFO_PAYLOAD = "Source Engine Query"
+# this request never changes, so it's only built once
+A2S_INFO_REQUEST = struct.pack('<lB', WHOLE, A2S_INFO_HEADER) + A2S_INFO_PAYLOAD.encode('utf-8') + b'\x00'
 
 A2S_RULES_HEADER = ord('V')
+A2S_RULES_RESPONSE_HEADER = ord('E')
 
 A2S_PLAYERS_HEADER = ord('U')
 
 CHALLENGE_NUMBER_REQUEST = -1
 CHALLENGE_NUMBER_HEADER = ord('A')
 
+"""Pre-compiled structs for the valve data types, so the format isn't parsed on every call"""
+
+_U8 = struct.Struct('<B')  # byte
+_S16 = struct.Struct('<h')  # short
+_S32 = struct.Struct('<l')  # long
+_U64 = struct.Struct('<Q')  # long long
+_F32 = struct.Struct('<f')  # float
+
+_NUL_BYTE = b'\x00'  # strings end with this
+_NUL = re.compile(_NUL_BYTE)  # re can search a memoryview in place
+
+_INFO_HEADER = struct.Struct('<BB')  # header, protocol
+_INFO_DETAILS = struct.Struct('<hBBBBBBB')  # id, players, max_players, bots, server_type, environment, visibility, vac
+_PLAYER_STATS = struct.Struct('<lf')  # score, duration
+_CHALLENGE_REQUEST = struct.Struct('<lBl')  # split, header, challenge number
+
+"""What the A2S_INFO codes mean. Anything not in here is left as it is
+These are read-only, so they're built once and shared by every Query"""
+
+_SERVER_TYPE = MappingProxyType({
+    ord('d'): 'Dedicated Server',
+    ord('l'): 'Non-dedicated Server',
+    ord('p'): 'SourceTV relay'
+})
+_ENVIRONMENT = MappingProxyType({
+    ord('l'): 'Linux',
+    ord('w'): 'Windows',
+    ord('m'): 'Mac',
+    ord('o'): 'Mac'
+})
+_VISIBILITY = MappingProxyType({0: 'Public', 1: 'Private'})
+_VAC = MappingProxyType({0: 'Unsecured', 1: 'Secured'})
+
 
 class QueryError(Exception):
     pass
@@ -34,6 +72,22 @@ class ChallengeError(Exception):
     pass
 
 
+def _string_end(buf, start):
+    """Returns where the string starting at start ends (the 0x00), without copying buf"""
+    match = _NUL.search(buf, start)
+    if match is None:
+        raise ValueError('string is not terminated with 0x00')
+    return match.start()
+
+
+def _decode_string(value):
+    """Decodes a string (bytes) from a packet, None if it isn't valid utf-8"""
+    try:
+        return value.decode('utf-8')
+    except ValueError:
+        return None
+
+
 class SourcePacket(BytesIO):
     """This will help store and make packets for steam queries
      This goes with the valve query data types. For example, strings will always end with 0x00
@@ -41,55 +95,150 @@ class SourcePacket(BytesIO):
 
      This class helps write and reads:
      byte, short, long (ints), long_long, float, string
+     (unpack() can also read a few fields at once with a struct.Struct)
 
      This uses struct to help pack and unpack the data
-     Besides strings."""
+     Besides strings.
+
+     Reading is done straight from a view of the internal buffer (unpack_from)
+     rather than copying each field out with read1().
+     The view is only held for the one read, so the packet can still be written to / resized."""
+    # only here to match ReadCursor. BytesIO already has a __dict__ / __weakref__, so this saves nothing
+    __slots__ = ()
+
+    def unpack(self, fmt):
+        """Unpacks fmt (a struct.Struct) at the current position and moves past it"""
+        pos = self.tell()
+        with self.getbuffer() as buf:
+            value = fmt.unpack_from(buf, pos)
+        self.seek(pos + fmt.size)
+        return value
+
     def write_byte(self, value):
-        self.write(struct.pack('<B', value))
+        self.write(_U8.pack(value))
 
     def get_byte(self):
-        return struct.unpack('<B', self.read1(1))[0]
+        return self.unpack(_U8)[0]
 
     def write_short(self, value):
-        self.write(struct.pack('<h', value))
+        self.write(_S16.pack(value))
 
     def get_short(self):
-        return struct.unpack('<h', self.read1(2))[0]
+        return self.unpack(_S16)[0]
 
     def write_long(self, value):
-        self.write(struct.pack('<l', value))
+        self.write(_S32.pack(value))
 
     def get_long(self):
-        return struct.unpack('<l', self.read1(4))[0]
+        return self.unpack(_S32)[0]
 
     def write_long_long(self, value):
-        self.write(struct.pack('<Q', value))
+        self.write(_U64.pack(value))
 
     def get_long_long(self):
-        return struct.unpack('<Q', self.read1(8))[0]
+        return self.unpack(_U64)[0]
 
     def write_float(self, value):
-        self.write(struct.pack('<f', value))
+        self.write(_F32.pack(value))
 
     def get_float(self):
-        return struct.unpack('<f', self.read1(4))[0]
+        return self.unpack(_F32)[0]
 
     def write_string(self, value):
         """Converting the string to bytes and writing to it"""
-        value = bytes(value, 'utf-8')
-        value = value + b'\x00'
-        self.write(value)
+        self.write(value.encode('utf-8'))
+        self.write(_NUL_BYTE)
 
     def get_string(self):
-        value = self.getvalue()
         start = self.tell()
-        end = value.index(b'\x00', start)  # getting the end of the string
-        value = value[start:end]  # grabbing only the string, nothing else
-        value = value.decode("utf-8")
+        with self.getbuffer() as buf:
+            end = _string_end(buf, start)  # getting the end of the string
+            with buf[start:end] as value:  # grabbing only the string, nothing else
+                value = str(value, 'utf-8')
         self.seek(end + 1)  # going to the next bit (passing the 0x00)
         return value
 
 
+class ReadCursor:
+    """This is used to read the packets we receive
+    Rather than copying the data into a BytesIO (like SourcePacket), this just keeps
+    a memoryview of the packet and the position we're at.
+
+    buf is the memoryview of the packet, pos is the offset of the next field.
+    This reads the same data types as SourcePacket:
+    byte, short, long (ints), long_long, float, string
+    unpack() can also read a few fields at once with a struct.Struct"""
+    __slots__ = ('buf', 'pos')
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+
+    def unpack(self, fmt):
+        """Unpacks fmt (a struct.Struct) at the current position and moves past it"""
+        value = fmt.unpack_from(self.buf, self.pos)
+        self.pos += fmt.size
+        return value
+
+    def get_byte(self):
+        return self.unpack(_U8)[0]
+
+    def get_short(self):
+        return self.unpack(_S16)[0]
+
+    def get_long(self):
+        return self.unpack(_S32)[0]
+
+    def get_long_long(self):
+        return self.unpack(_U64)[0]
+
+    def get_float(self):
+        return self.unpack(_F32)[0]
+
+    def get_string(self):
+        """Reads a string. If it isn't valid utf-8, this still moves past it before raising"""
+        start = self.pos
+        end = _string_end(self.buf, start)  # getting the end of the string
+        self.pos = end + 1  # going to the next bit (passing the 0x00)
+        return str(self.buf[start:end], 'utf-8')
+
+
+"""The extra data fields (EDF) of A2S_INFO, in the order they come in the packet
+Each one is (flag, key, reader). SourceTV has two fields under the same flag"""
+
+_EDF_FIELDS = (
+    (0x80, 'port', ReadCursor.get_short),
+    (0x10, 'steamid', ReadCursor.get_long_long),
+    (0x40, 'sourcetv_port', ReadCursor.get_short),
+    (0x40, 'sourcetv_name', ReadCursor.get_string),
+    (0x20, 'keywords', ReadCursor.get_string),
+    (0x01, 'gameid', ReadCursor.get_long_long)
+)
+
+
+def build_request(header, payload=None):
+    """
+    Builds a request packet: WHOLE, the header byte, then the payload (if any)
+    The size is known up front, so this packs everything into one pre-sized bytearray
+    instead of growing a SourcePacket with every write.
+
+    payload can either be a string (used by A2S_INFO) or a long (used by challenge)
+    """
+    if payload and isinstance(payload, str):
+        value = payload.encode('utf-8')
+        buf = bytearray(5 + len(value) + 1)  # the last byte is left as the 0x00 terminator
+        buf[5:-1] = value
+    elif payload and isinstance(payload, int):
+        buf = bytearray(9)
+        _S32.pack_into(buf, 5, payload)
+    else:
+        buf = bytearray(5)
+
+    _S32.pack_into(buf, 0, WHOLE)
+    _U8.pack_into(buf, 4, header)
+    return bytes(buf)
+
+
 class Query:
     def __init__(self, address, port, timeout=10.0):
         self.address = (address, port)
@@ -98,37 +247,44 @@ class Query:
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.connection.settimeout(self.timeout)
 
+        # every datagram is received into this same buffer, rather than allocating a new one each time
+        self._rxbuf = bytearray(PACKET_SIZE)
+        self._rxview = memoryview(self._rxbuf)
+        # same for the challenge requests, they're always the same size
+        self._chal_buf = bytearray(_CHALLENGE_REQUEST.size)
+
     def receive(self, send_time=False):
         """
         Receives the packet that comes in.
         This is separated because of split packets.
 
         This will automatically handle and combine split packets.
-        This will also return the whole packet (including the header / split))
+        This will return the whole packet, but it's already past the split (-1) header.
+        So the first thing to read is the response header.
 
         This can also return the time after receiving the first packet. Useful for pings
         (used in self.send())
+
+        Note: a whole (non split) packet points into the receive buffer.
+        It's only valid until the next receive, so copy it if it needs to be kept.
         """
-        data = self.connection.recv(PACKET_SIZE)
+        length = self.connection.recv_into(self._rxbuf)
         ping = time.time()
 
-        data = SourcePacket(data)
-
+        # checking the header straight from the received data, most responses are whole packets
+        data = ReadCursor(self._rxview[:length])
         header = data.get_long()
         if header == WHOLE:
-            data.seek(0, 0)
             if send_time:
                 return data, ping
             else:
                 return data
         else:
-            packets = {}  # all the split packets received
-            data.seek(0, 0)  # going back to the beginning of the packet
+            packets = None  # all the split packets received, in order
             old_packet_id = None
 
             # grabbing all the split packets
             while True:
-                header = data.get_long()
                 packet_id = data.get_long()
 
                 if packet_id != old_packet_id and old_packet_id is not None:
@@ -138,27 +294,33 @@ class Query:
                 total = data.get_byte()
                 number = data.get_byte()
                 size = data.get_short()
-                packets[number] = data.read()
+
+                if packets is None:
+                    packets = [None] * total
+                    received = 0
+                if number >= len(packets):
+                    raise QueryError(f'Received split packet number {number}, expected only {len(packets)}')
+
+                if packets[number] is None:
+                    received += 1
+                packets[number] = bytes(data.buf[data.pos:])  # copied, the receive buffer gets reused
 
                 # making sure we're not at the end
-                if len(packets) > total - 1:
+                if received == len(packets):
                     break
 
-                # Receiving another packet
-                data = SourcePacket(self.connection.recv(PACKET_SIZE))
+                # Receiving another packet (skipping its split header)
+                length = self.connection.recv_into(self._rxbuf)
+                data = ReadCursor(self._rxview[:length], _S32.size)
 
-            # combining the packets, making sure they're in order
-            try:
-                packet = b""
-                for x in range(len(packets)):
-                    packet += packets[x]
-            except KeyError:
-                raise QueryError('Missing a split packet')
+            # combining the packets, they're already in order
+            # the combined packet has its own header, which is skipped like a whole packet
+            packet = ReadCursor(memoryview(b"".join(packets)), _S32.size)
 
             if send_time:
-                return SourcePacket(packet), ping
+                return packet, ping
             else:
-                return SourcePacket(packet)
+                return packet
 
     def send(self, header, payload=None, ping=False):
         """
@@ -166,19 +328,22 @@ class Query:
         Reason why this is in a separate method is because it was repeated a lot.
 
         This also can return the time it took to send / receive. (Useful for pings)
+
+        Note: like self.receive(), a whole packet points into the receive buffer.
+        It's only valid until the next request on this Query, so copy it if it needs to be kept.
+        """
+        return self.send_packet(build_request(header, payload), ping)
+
+    def send_packet(self, packet, ping=False):
+        """
+        Same as self.send(), but sends an already built packet (bytes / bytearray)
+
+        This also can return the time it took to send / receive. (Useful for pings)
+
+        Note: like self.receive(), a whole packet points into the receive buffer.
+        It's only valid until the next request on this Query, so copy it if it needs to be kept.
         """
-        packet = SourcePacket()
-        packet.write_long(WHOLE)
-        packet.write_byte(header)
-        if payload:
-            if isinstance(payload, str):
-                # used by A2S_INFO
-                packet.write_string(payload)
-            elif isinstance(payload, int):
-                # used by challenge
-                packet.write_long(payload)
-
-        self.connection.sendto(packet.getvalue(), self.address)
+        self.connection.sendto(packet, self.address)
 
         past = time.time()
         packet, now = self.receive(send_time=True)
@@ -197,26 +362,26 @@ class Query:
         This is mostly used by A2S_PLAYERS and A2S_RULES
         """
         # grabbing the challenge number
-        packet = self.send(header, CHALLENGE_NUMBER_REQUEST)
-        packet.get_long()  # split
+        _CHALLENGE_REQUEST.pack_into(self._chal_buf, 0, WHOLE, header, CHALLENGE_NUMBER_REQUEST)
+        packet = self.send_packet(self._chal_buf)
 
-        rec_header = packet.get_byte()
-        if chr(rec_header) == 'E':
+        rec_header = _U8.unpack_from(packet.buf, packet.pos)[0]  # only peeking, so the header can still be read after
+        if rec_header == A2S_RULES_RESPONSE_HEADER:
             # server didn't send a challenge number, but sent the packet we're looking for
-            # basically, the server sent the rules or players packet rather than the challenge number
-            packet.seek(0, 0)
+            # basically, the server sent the rules packet rather than the challenge number
+            # NOTE: only the rules response ('E') is detected here, not the players one ('D')
             return packet
 
         # requesting with the challenge
+        packet.get_byte()  # header
         challenge = packet.get_long()
-        packet = self.send(header, challenge)
+        _CHALLENGE_REQUEST.pack_into(self._chal_buf, 0, WHOLE, header, challenge)
+        packet = self.send_packet(self._chal_buf)
 
-        packet.get_long()  # split
-        rec_header = packet.get_byte()
+        rec_header = _U8.unpack_from(packet.buf, packet.pos)[0]
         if rec_header == CHALLENGE_NUMBER_HEADER:
             raise ChallengeError(f'Sent {challenge} and got back challenge number')
 
-        packet.seek(0, 0)
         return packet
 
     def info(self):
@@ -235,57 +400,27 @@ class Query:
         Note: This method does change the values a tiny bit.
             - For example, if you got server_type = 'd'. This method will set this to "Dedicated Server"
         """
-        packet, ping = self.send(A2S_INFO_HEADER, A2S_INFO_PAYLOAD, True)
+        packet, ping = self.send_packet(A2S_INFO_REQUEST, True)
+        header, protocol = packet.unpack(_INFO_HEADER)
         data = {
             'ping': ping,
-            'raw': packet.getvalue(),
-            'split': packet.get_long(),
-            'header': chr(packet.get_byte()),
-            'protocol': packet.get_byte(),
+            'raw': bytes(packet.buf),
+            'split': _S32.unpack_from(packet.buf, 0)[0],
+            'header': chr(header),
+            'protocol': protocol,
             'name': packet.get_string(),
             'map': packet.get_string(),
             'folder': packet.get_string(),
-            'game': packet.get_string(),
-            'id': packet.get_short(),
-            'players': packet.get_byte(),
-            'max_players': packet.get_byte(),
-            'bots': packet.get_byte()
+            'game': packet.get_string()
         }
-        server_type = chr(packet.get_byte())
-        if server_type == 'd':
-            server_type = 'Dedicated Server'
-        elif server_type == 'l':
-            server_type = 'Non-dedicated Server'
-        elif server_type == 'p':
-            server_type = 'SourceTV relay'
-
-        data['server_type'] = server_type
-
-        environment = chr(packet.get_byte())
-        if environment == 'l':
-            environment = 'Linux'
-        elif environment == 'w':
-            environment = 'Windows'
-        elif environment == 'm' or environment == 'o':
-            environment = 'Mac'
-
-        data['environment'] = environment
-
-        visibility = packet.get_byte()
-        if visibility == 1:
-            visibility = 'Private'
-        elif visibility == 0:
-            visibility = 'Public'
-
-        data['visibility'] = visibility
-
-        vac = packet.get_byte()
-        if vac == 1:
-            vac = 'Secured'
-        elif vac == 0:
-            vac = 'Unsecured'
-
-        data['vac'] = vac
+        # the fixed fields between the strings are grabbed in one go
+        (data['id'], data['players'], data['max_players'], data['bots'],
+         server_type, environment, visibility, vac) = packet.unpack(_INFO_DETAILS)
+
+        data['server_type'] = _SERVER_TYPE.get(server_type) or chr(server_type)
+        data['environment'] = _ENVIRONMENT.get(environment) or chr(environment)
+        data['visibility'] = _VISIBILITY.get(visibility, visibility)
+        data['vac'] = _VAC.get(vac, vac)
 
         # TODO: insert the ship fields here
 
@@ -295,17 +430,9 @@ class Query:
         data['edf'] = edf
         # getting the extra data fields (EDF)
         if edf:
-            if edf & 0x80:
-                data['port'] = packet.get_short()
-            if edf & 0x10:
-                data['steamid'] = packet.get_long_long()
-            if edf & 0x40:
-                data['sourcetv_port'] = packet.get_short()
-                data['sourcetv_name'] = packet.get_string()
-            if edf & 0x20:
-                data['keywords'] = packet.get_string()
-            if edf & 0x01:
-                data['gameid'] = packet.get_long_long()
+            for flag, key, reader in _EDF_FIELDS:
+                if edf & flag:
+                    data[key] = reader(packet)
 
         return data
 
@@ -327,25 +454,36 @@ class Query:
         """
         packet = self.receive_challenge(A2S_RULES_HEADER)
 
-        packet.get_long()  # split
         packet.get_byte()  # header
         total_rules = packet.get_short()
 
-        rules = {}
-        for _ in range(total_rules):
-            # sometimes the packet is cut off. So we will do some try statements
-            # if the header is cut off, we'll ignore it
-            # if the value is cut off, we'll put in the header and error message
+        # the rules are just name / value strings back to back.
+        # so rather than reading them one at a time, they're all decoded and split up in one go
+        data = bytes(packet.buf[packet.pos:])
+        # whatever is after the last 0x00 is either nothing, or a string that got cut off
+        end = data.rfind(_NUL_BYTE)
+        if end == -1:
+            strings = []
+        else:
             try:
-                name = packet.get_string()
-            except ValueError:
-                pass
-            else:
-                try:
-                    value = packet.get_string()
-                except ValueError:
-                    value = "N/A - packet cut off"
-                rules[name] = value
+                strings = data[:end].decode('utf-8').split('\x00')
+            except UnicodeDecodeError:
+                # one of the rules isn't valid utf-8, so each string is decoded on its own
+                # the ones that can't be decoded are left as None
+                strings = [_decode_string(value) for value in data[:end].split(_NUL_BYTE)]
+
+        rules = {}
+        for x in range(0, min(len(strings), total_rules * 2), 2):
+            # sometimes the packet is cut off, or a string isn't valid utf-8
+            # if the header is cut off (or can't be decoded), we'll ignore it
+            # if the value is cut off (or can't be decoded), we'll put in the header and error message
+            name = strings[x]
+            if name is None:
+                continue
+            value = strings[x + 1] if x + 1 < len(strings) else None
+            if value is None:
+                value = "N/A - packet cut off"
+            rules[name] = value
 
         return rules
 
@@ -370,21 +508,39 @@ class Query:
             https://developer.valvesoftware.com/wiki/Server_queries
         """
         packet = self.receive_challenge(A2S_PLAYERS_HEADER)
-        packet.get_long()  # split
         packet.get_byte()  # header
 
         number_of_players = packet.get_byte()
+        # looking these up once, rather than every player
+        get_byte = packet.get_byte
+        get_string = packet.get_string
+        unpack = packet.unpack
+
         players = list(range(number_of_players))
         for x in range(number_of_players):
             try:
-                players[x] = {
-                    'index': packet.get_byte(),
-                    'name': packet.get_string(),
-                    'score': packet.get_long(),
-                    'duration': packet.get_float()
-                }
+                index = get_byte()
+                try:
+                    name = get_string()
+                except UnicodeDecodeError:
+                    # the name isn't valid utf-8, but we're already past it
+                    # so only this player is skipped (left as a number)
+                    name = None
+                # score and duration are right next to each other, so they're grabbed together
+                score, duration = unpack(_PLAYER_STATS)
             except (ValueError, struct.error):
                 #  sometimes we don't get the whole packet
-                pass
+                #  once a player is cut off, there's nothing left to read for the rest
+                break
+
+            if name is None:
+                continue
+
+            players[x] = {
+                'index': index,
+                'name': name,
+                'score': score,
+                'duration': duration
+            }
 
         return players